@@ -21,10 +21,11 @@ from . import collections as colls
 from .exception import ClefException
 from .code import load_vocabularies, call_local_query, fix_model, fix_path, matching, write_csv, print_stats, ids_dict
 import click
+import functools
 import logging
+from sqlalchemy import select
 from datetime import datetime
 import sys
-import six
 import os
 import stat
 import pkg_resources
@@ -102,31 +103,90 @@ def warning(message):
     print("WARNING: %s"%message, file=sys.stderr)
 
 
-def cmip5_args(f):
-    models, realms, variables, frequencies, tables, experiments, attributes, families = load_vocabularies('CMIP5')
-    constraints = [
-        click.option('--experiment', '-e', multiple=True, type=click.Choice(experiments), metavar='x',
+def print_rows(rows):
+    '''Print an iterable of values one per line, buffering the output
+
+    A single write per batch is much faster than one print call per row
+    when a large result set goes to a terminal or a pipe.
+    '''
+    write = sys.stdout.write
+    buf = []
+    for row in rows:
+        buf.append(f'{row}\n')
+        if len(buf) >= 1000:
+            write(''.join(buf))
+            buf.clear()
+    if buf:
+        write(''.join(buf))
+
+
+class LazyChoice(click.Choice):
+    """click.Choice which defers loading the valid values
+
+    The vocabularies are read only when a value has to be validated or the
+    subcommand help rendered, so importing this module or invoking an
+    unrelated subcommand does not pay the json parsing cost.
+    """
+
+    def __init__(self, loader, case_sensitive=True):
+        self._loader = loader
+        self._choice_set = None
+        self.case_sensitive = case_sensitive
+
+    @property
+    def choices(self):
+        return self._loader()
+
+    def convert(self, value, param, ctx):
+        # validate against a frozenset, a membership test is O(1) there while
+        # click scans the choices tuple linearly; anything that misses falls
+        # back to click for case handling and the usual error message
+        if self._choice_set is None:
+            self._choice_set = frozenset(self.choices)
+        if value in self._choice_set:
+            return value
+        return super().convert(value, param, ctx)
+
+
+def vocab_choices(project, nfields):
+    '''Return a list of lazy Choice types, one per load_vocabularies field'''
+    return [LazyChoice(lambda i=i: load_vocabularies(project)[i]) for i in range(nfields)]
+
+
+def compose_args(f, constraints):
+    '''Apply a tuple of click constraint decorators to a command function'''
+    for c in reversed(constraints):
+        f = c(f)
+    return f
+
+
+@functools.lru_cache(maxsize=None)
+def cmip5_constraints():
+    models, realms, variables, frequencies, tables, experiments, attributes, families = vocab_choices('CMIP5', 8)
+    return (
+        click.option('--experiment', '-e', multiple=True, type=experiments, metavar='x',
                       help="CMIP5 experiment: piControl, rcp85, amip ..."),
-        click.option('--experiment_family',multiple=False, type=click.Choice(families),
+        click.option('--experiment_family',multiple=False, type=families,
                       help="CMIP5 experiment family: Decadal, RCP ..."),
-        click.option('--model', '-m', multiple=True, type=click.Choice(models),  metavar='x',
+        click.option('--model', '-m', multiple=True, type=models,  metavar='x',
                       help="CMIP5 model acronym: ACCESS1.3, MIROC5 ..."),
-        click.option('--table', '--mip', '-t', 'cmor_table', multiple=True, type=click.Choice(tables) ),
-        click.option('--variable', '-v', multiple=True, type=click.Choice(variables), metavar='x',
+        click.option('--table', '--mip', '-t', 'cmor_table', multiple=True, type=tables ),
+        click.option('--variable', '-v', multiple=True, type=variables, metavar='x',
                       help="Variable name as shown in filanames: tas, pr, sic ... "),
         click.option('--ensemble', '--member', '-en', 'ensemble', multiple=True, help="CMIP5 ensemble member: r#i#p#"),
-        click.option('--frequency', 'time_frequency', multiple=True, type=click.Choice(frequencies) ),
-        click.option('--realm', multiple=True, type=click.Choice(realms) ),
-        click.option('--and', 'and_attr', multiple=True, type=click.Choice(attributes),
+        click.option('--frequency', 'time_frequency', multiple=True, type=frequencies ),
+        click.option('--realm', multiple=True, type=realms ),
+        click.option('--and', 'and_attr', multiple=True, type=attributes,
                       help=("Attributes for which we want to add AND filter, i.e. `--and variable` to apply to variable values")),
         click.option('--institution', 'institute', multiple=True, help="Modelling group institution id: MIROC, IPSL, MRI ...")
-    ]
-    for c in reversed(constraints):
-        f = c(f)
-    return f
+    )
 
-def common_args(f):
-    constraints = [
+def cmip5_args(f):
+    return compose_args(f, cmip5_constraints())
+
+@functools.lru_cache(maxsize=None)
+def common_constraints():
+    return (
         click.argument('query', nargs=-1),
         click.option('--cf_standard_name',multiple=True, help="CF variable standard_name, use instead of variable constraint "),
         click.option('--format', 'oformat', type=click.Choice(['file','dataset']), default='dataset',
@@ -142,43 +202,45 @@ def common_args(f):
         click.option('--stats/--no-stats',  default=False,
                      help="Write summary of query results, works only with --local option. Default: --no-stats"),
         click.option('--debug/--no-debug', default=False,
-                     help="Show debug output. Default: --no-debug")
-    ]
-    for c in reversed(constraints):
-        f = c(f)
-    return f
+                     help="Show debug output. Default: --no-debug"),
+        click.option('--sql-debug/--no-sql-debug', 'sql_debug', default=False,
+                     help="Log every SQL statement sent to the database. Default: --no-sql-debug")
+    )
 
-def cmip6_args(f):
-    #
-    models, realms, variables, frequencies, tables, experiments, attributes, activities, stypes = load_vocabularies('CMIP6')
-    constraints = [
-        click.option('--activity', '-mip', 'activity_id', multiple=True, type=click.Choice(activities) ) ,
-        click.option('--experiment', '-e', 'experiment_id', multiple=True, type=click.Choice(experiments), metavar='x',
+def common_args(f):
+    return compose_args(f, common_constraints())
+
+@functools.lru_cache(maxsize=None)
+def cmip6_constraints():
+    models, realms, variables, frequencies, tables, experiments, attributes, activities, stypes = vocab_choices('CMIP6', 9)
+    return (
+        click.option('--activity', '-mip', 'activity_id', multiple=True, type=activities ) ,
+        click.option('--experiment', '-e', 'experiment_id', multiple=True, type=experiments, metavar='x',
                      help="CMIP6 experiment, list of available depends on activity"),
-        click.option('--source_type',multiple=True, type=click.Choice(stypes) ),
-        click.option('--table', '-t', 'table_id', multiple=True, type=click.Choice(tables), metavar='x',
+        click.option('--source_type',multiple=True, type=stypes ),
+        click.option('--table', '-t', 'table_id', multiple=True, type=tables, metavar='x',
                      help="CMIP6 CMOR table: Amon, SIday, Oday ..."),
-        click.option('--model', '--source_id','-m', 'source_id', multiple=True, type=click.Choice(models),  metavar='x',
+        click.option('--model', '--source_id','-m', 'source_id', multiple=True, type=models,  metavar='x',
                      help="CMIP6 model id: GFDL-AM4, CNRM-CM6-1 ..."),
-        click.option('--variable', 'variable_id', '-v', multiple=True, type=click.Choice(variables),  metavar='x',
+        click.option('--variable', 'variable_id', '-v', multiple=True, type=variables,  metavar='x',
                      help="CMIP6 variable name as in filenames"),
         click.option('--member', '-mi', 'member_id', multiple=True, help="CMIP6 member id: <sub-exp-id>-r#i#p#f#"),
         click.option('--grid', '--grid_label', '-g', 'grid_label', multiple=True,
                      help="CMIP6 grid label: i.e. gn for the model native grid"),
         click.option('--resolution', '--nominal_resolution','-nr' , 'nominal_resolution', multiple=True,
                      help="Approximate resolution: '250 km', pass in quotes"),
-        click.option('--frequency',multiple=True, type=click.Choice(frequencies) ),
-        click.option('--realm', multiple=True, type=click.Choice(realms) ),
+        click.option('--frequency',multiple=True, type=frequencies ),
+        click.option('--realm', multiple=True, type=realms ),
         click.option('--sub_experiment_id', '-se', multiple=True,
                      help="Only available for hindcast and forecast experiments: sYYYY"),
         click.option('--variant_label', '-vl', multiple=True, help="Indicates a model variant: r#i#p#f#"),
-        click.option('--and', 'and_attr', multiple=True, type=click.Choice(attributes),
+        click.option('--and', 'and_attr', multiple=True, type=attributes,
                       help=("Attributes for which we want to add AND filter, i.e. `--and variable_id` to apply to variable values")),
         click.option('--institution', 'institution_id', multiple=True, help="Modelling group institution id: IPSL, NOAA-GFDL ...")
-    ]
-    for c in reversed(constraints):
-        f = c(f)
-    return f
+    )
+
+def cmip6_args(f):
+    return compose_args(f, cmip6_constraints())
 
 
 def ds_args(f):
@@ -208,15 +270,13 @@ def ds_args(f):
         click.option('--to-date', 'tdate', multiple=False, help="""To define a time range of availability of a variable,
                       can be used on its own or together with from-date. Format is YYYYMMDD""")
     ]
-    for c in reversed(constraints):
-        f = c(f)
-    return f
+    return compose_args(f, constraints)
 
 @clef.command()
 @cmip5_args
 @common_args
 @click.pass_context
-def cmip5(ctx, query, debug, distrib, replica, latest, oformat, csvf, stats,
+def cmip5(ctx, query, debug, sql_debug, distrib, replica, latest, oformat, csvf, stats,
         cf_standard_name,
         ensemble,
         experiment,
@@ -238,32 +298,33 @@ def cmip5(ctx, query, debug, distrib, replica, latest, oformat, csvf, stats,
     project='CMIP5'
 
     # check model name is ESGF-valid (i.e. ACCESS1.0 no ACCESS1-0
-    if len(model) > 0:
+    if model:
         model = fix_model(project, model)
     # change experiment_family to tuple to behave like other arguments
     if experiment_family == None:
         experiment_family = ()
     else:
         experiment_family = (experiment_family,)
-    dataset_constraints = {
-        'ensemble': ensemble,
-        'experiment': experiment,
-        'institute': institute,
-        'model': model,
-        'realm': realm,
-        'time_frequency': time_frequency,
-        'cmor_table': cmor_table,
-        'variable': variable,
-        'experiment_family': experiment_family
-        }
-    common_esgf_cli(ctx, project, query, cf_standard_name, oformat, latest, replica, distrib, csvf, stats, debug, dataset_constraints, and_attr)
+    # build the constraints dictionary dropping unset options as we go
+    constraints = {k: v for k, v in (
+        ('ensemble', ensemble),
+        ('experiment', experiment),
+        ('institute', institute),
+        ('model', model),
+        ('realm', realm),
+        ('time_frequency', time_frequency),
+        ('cmor_table', cmor_table),
+        ('variable', variable),
+        ('experiment_family', experiment_family),
+        ) if v}
+    common_esgf_cli(ctx, project, query, cf_standard_name, oformat, latest, replica, distrib, csvf, stats, debug, sql_debug, constraints, and_attr)
 
 
 @clef.command()
 @cmip6_args
 @common_args
 @click.pass_context
-def cmip6(ctx,query, debug, distrib, replica, latest, oformat, csvf, stats,
+def cmip6(ctx,query, debug, sql_debug, distrib, replica, latest, oformat, csvf, stats,
         cf_standard_name,
         variant_label,
         member_id,
@@ -290,38 +351,58 @@ def cmip6(ctx,query, debug, distrib, replica, latest, oformat, csvf, stats,
 
     project='CMIP6'
 
-    dataset_constraints = {
-        'activity_id': activity_id,
-        'experiment_id': experiment_id,
-        'frequency': frequency,
-        'grid_label': grid_label,
-        'institution_id': institution_id,
-        'member_id': member_id,
-        'nominal_resolution': nominal_resolution,
-        'realm': realm,
-        'source_id': source_id,
-        'source_type': source_type,
-        'sub_experiment_id': sub_experiment_id,
-        'table_id': table_id,
-        'variable_id': variable_id,
-        'variant_label': variant_label,
-        }
+    # build the constraints dictionary dropping unset options as we go
+    constraints = {k: v for k, v in (
+        ('activity_id', activity_id),
+        ('experiment_id', experiment_id),
+        ('frequency', frequency),
+        ('grid_label', grid_label),
+        ('institution_id', institution_id),
+        ('member_id', member_id),
+        ('nominal_resolution', nominal_resolution),
+        ('realm', realm),
+        ('source_id', source_id),
+        ('source_type', source_type),
+        ('sub_experiment_id', sub_experiment_id),
+        ('table_id', table_id),
+        ('variable_id', variable_id),
+        ('variant_label', variant_label),
+        ) if v}
 
     common_esgf_cli(ctx, project, query, cf_standard_name, oformat, latest,
-        replica, distrib, csvf, stats, debug, dataset_constraints, and_attr)
+        replica, distrib, csvf, stats, debug, sql_debug, constraints, and_attr)
 
 
 def common_esgf_cli(ctx, project, query, cf_standard_name, oformat, latest,
-               replica, distrib, csvf, stats, debug, constraints, and_attr):
+               replica, distrib, csvf, stats, debug, sql_debug, constraints, and_attr):
     if debug:
         logging.basicConfig(level=logging.DEBUG)
+    # statement logging formats a record per statement and per row, keep it
+    # behind its own flag so --debug alone does not slow large queries down
+    if sql_debug:
+        # a handler must be configured or the INFO records are dropped;
+        # when --debug is also given its DEBUG root level wins above
+        logging.basicConfig(level=logging.INFO)
         logging.getLogger('sqlalchemy.engine').setLevel(level=logging.INFO)
 
+    # join the free text query terms once for both the remote and local flows
+    query_str = ' '.join(query)
+
+    # refuse to run a search with nothing to constrain it, it would attempt
+    # to list the entire catalogue
+    if not (constraints or query_str or cf_standard_name):
+        raise ClefException("No search constraints defined, please provide at least "
+                            "one constraint option, a free text query or --cf_standard_name")
+
     clef_log = ctx.obj['log']
     user_name=os.environ.get('USER','unknown')
     user=None
     connect(user=user)
     s = Session()
+    # procure the session connection up front with a compiled-SQL cache, the
+    # match_query/find_local_path/find_missing_id statements all run on this
+    # one connection and share compiled fragments of the same subquery
+    s.connection(execution_options={'compiled_cache': {}})
 
     matching_fixed = {
         'CMIP5': ['model','ensemble'],
@@ -332,20 +413,14 @@ def common_esgf_cli(ctx, project, query, cf_standard_name, oformat, latest,
     args_str = ' '.join('{}={}'.format(k,v) for k,v in constraints.items())
     clef_log.info('  ;  '.join([user_name,project,ctx.obj['flow'],args_str]))
 
-    terms = {}
-    # Add filters
-    for key, value in six.iteritems(constraints):
-        if value is not None and len(value) > 0:
-            terms[key] = value
-
     if ctx.obj['flow'] == 'remote':
-        if len(and_attr) > 0:
+        if and_attr:
             results, selection = matching(s, and_attr, matching_fixed[project], project=project,
-                                          local=False, latest=latest, **terms)
+                                          local=False, latest=latest, **constraints)
             for row in selection:
                 print(*[row[x] for x in matching_fixed[project]], row['version'])
         else:
-            q = find_checksum_id(' '.join(query),
+            q = find_checksum_id(query_str,
                 distrib=distrib,
                 replica=replica,
                 latest=latest,
@@ -354,17 +429,18 @@ def common_esgf_cli(ctx, project, query, cf_standard_name, oformat, latest,
                 **constraints,
                 )
 
+            # only single columns are needed here, execute plain selects so no
+            # ORM row objects are built just to be unpacked again
             if oformat == 'file':
-                for result in s.query(q):
-                    print(result.id)
+                print_rows(rid for (rid,) in s.execute(select([q.c.id])))
                 return
             else:
-                ids=sorted(set(x.dataset_id for x in s.query(q)))
+                # let the database deduplicate instead of building a set in python
+                ids=sorted(did for (did,) in s.execute(select([q.c.dataset_id]).distinct()))
 # when stats or csvf are True first extract attributes from dataset_ids
                 if stats or csvf:
                     results = ids_dict(ids)
-                for did in ids:
-                    print(did)
+                print_rows(ids)
         if stats:
             print_stats(results)
         if csvf:
@@ -373,16 +449,15 @@ def common_esgf_cli(ctx, project, query, cf_standard_name, oformat, latest,
 
     # if local query MAS based on attributes not checksums
     if ctx.obj['flow'] == 'local':
-        if len(and_attr) > 0:
+        if and_attr:
             results, selection = matching(s, and_attr, matching_fixed[project], project=project,
-                                          local=True, latest=latest, **terms)
+                                          local=True, latest=latest, **constraints)
             for row in selection:
                 print(*[row[x] for x in matching_fixed[project]], row['version'])
         else:
-            results, paths = call_local_query(s, project, oformat, latest, **terms)
+            results, paths = call_local_query(s, project, oformat, latest, **constraints)
             if not stats:
-                for p in paths:
-                    print(p)
+                print_rows(paths)
         if csvf:
             write_csv(results)
         if stats:
@@ -390,13 +465,13 @@ def common_esgf_cli(ctx, project, query, cf_standard_name, oformat, latest,
         return
 
     # if not local, query ESGF first and then MAS based on checksums
-    subq = match_query(s, query=' '.join(query),
+    subq = match_query(s, query=query_str,
             distrib=distrib,
             replica=replica,
             latest=(latest if latest else None),
             cf_standard_name=cf_standard_name,
             project=project,
-            **terms
+            **constraints
             )
 
     # Make sure that if find_local_path does an all-version search using the
@@ -408,32 +483,31 @@ def common_esgf_cli(ctx, project, query, cf_standard_name, oformat, latest,
         if project == 'CMIP5':
             # temporary fix to return only one combined path instead of 1 or 2 output ones
             cpaths = sorted(set(map(fix_path, [p[0] for p in ql], repeat(latest))))
-            for p in cpaths:
-                print(p)
+            print_rows(cpaths)
         else:
-            for result in ql:
-                print(result[0])
+            print_rows(result[0] for result in ql)
 
-    qm = find_missing_id(s, subq, oformat=oformat)
+    # materialize the missing ids once, rather than issuing a COUNT round-trip
+    # and then re-executing the query for each pass over the results
+    qm = find_missing_id(s, subq, oformat=oformat).all()
 
     # if there are missing datasets, search for dataset_id in synda queue,
     #  update list and print result
-    if qm.count() > 0:
+    if qm:
         varlist = []
-        if project == 'CMIP5' and 'variable' in terms:
-            varlist = terms['variable']
+        if project == 'CMIP5' and 'variable' in constraints:
+            varlist = constraints['variable']
         updated = search_queue_csv(qm, project, varlist)
         print('\nAvailable on ESGF but not locally:')
-        for result in updated:
-            print(result)
+        print_rows(updated)
     else:
         print('\nEverything available on ESGF is also available locally')
         return
 
     if ctx.obj['flow'] == 'request':
-        if project == 'CMIP5' and len(varlist) == 0:
+        if project == 'CMIP5' and not varlist:
             raise ClefException("Please specify at least one variable to request")
-        if len(updated) >0:
+        if updated:
             write_request(project,updated)
         else:
             print("\nAll the published data is already available locally, or has been requested, nothing to request")
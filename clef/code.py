@@ -22,13 +22,21 @@ from sqlalchemy import any_
 import pandas
 import sys
 import os
-import csv
+import functools
 import json
 import pkg_resources
 import itertools
+import mmap
 from calendar import monthrange
 import re
 
+# orjson is noticeably faster than the stdlib parser, fall back to json
+# when it is not installed
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
+
 
 def search(session, project='CMIP5', latest=True, **kwargs):
     """
@@ -41,40 +49,56 @@ def search(session, project='CMIP5', latest=True, **kwargs):
     vocabularies = load_vocabularies(project)
     check_values(vocabularies, project, args)
     if 'model' in args.keys():
-        args['model'] = fix_model(project, [args['model']])[0]
+        if isinstance(args['model'], (list, tuple, set)):
+            args['model'] = fix_model(project, list(args['model']))
+        else:
+            args['model'] = fix_model(project, [args['model']])[0]
     results = local_query(session, project, latest, **args)
     if latest:
         results = local_latest(results)
     return results
 
 
+# dataset table and path relationship to join for each project
+ctables={'CMIP5': [C5Dataset, Path.c5dataset],
+      'CMIP6': [C6Dataset, Path.c6dataset] }
+
+# experiment name patterns defining each CMIP5 experiment family
+family_dict = {'RCP': ['%rcp%'],
+               'ESM': ['esm%'],
+               'Atmos-only': ['sst%', 'amip%', 'aqua%'],
+               'Control': ['sstClim%', '%Control'],
+               'decadal': ['decadal%','noVolc%', 'volcIn%'],
+               'Idealized': ['%CO2'],
+               'Paleo': ['lgm','midHolocene', 'past1000'],
+               'historical': ['historical%','%Historical']}
+
+
 def local_query(session, project='CMIP5', latest=True, **kwargs):
     '''Query MAS matching directly the constraints to the file attributes instead of querying first the ESGF
     :input: session the db session
     :input: project 'CMIP5' by default
     :input: latest True by default
-    :input: kwargs a dictionary with the query constraints
+    :input: kwargs a dictionary with the query constraints, a value can be a
+            single value or a list/tuple which becomes a SQL IN filter
     :return: a list of dictionary, each dictionary describe one simulation matching the constraints
-    ''' 
+    '''
     # create empty list for results dictionaries
     # each dict will represent a file matching the constraints
     results=[]
     project = project.upper()
     # for cmip5 separate var from other constraints
-    if project == 'CMIP5' and 'variable' in kwargs.keys():
-        var = kwargs.pop('variable')
-    if project == 'CMIP5' and 'experiment_family' in kwargs.keys():
-        family = kwargs.pop('experiment_family')
-    ctables={'CMIP5': [C5Dataset, Path.c5dataset],
-          'CMIP6': [C6Dataset, Path.c6dataset] }
-    family_dict = {'RCP': ['%rcp%'],
-                   'ESM': ['esm%'],
-                   'Atmos-only': ['sst%', 'amip%', 'aqua%'],
-                   'Control': ['sstClim%', '%Control'],
-                   'decadal': ['decadal%','noVolc%', 'volcIn%'],
-                   'Idealized': ['%CO2'],
-                   'Paleo': ['lgm','midHolocene', 'past1000'],
-                   'historical': ['historical%','%Historical']}
+    var = kwargs.pop('variable', None) if project == 'CMIP5' else None
+    family = kwargs.pop('experiment_family', None) if project == 'CMIP5' else None
+
+    dstable = ctables[project][0]
+    filters = []
+    for k,v in kwargs.items():
+        attr = getattr(dstable, k)
+        if isinstance(v, (list, tuple, set)):
+            filters.append(attr.in_(v))
+        else:
+            filters.append(attr == v)
 
     r = (session.query(Path.path.label('path'),
          *[c.label(c.name) for c in ctables[project][0].__table__.columns if c.name != 'dataset_id'],
@@ -82,27 +106,66 @@ def local_query(session, project='CMIP5', latest=True, **kwargs):
         )
         .join(Path.extended)
         .join(ctables[project][1])
-        .filter_by(**kwargs))
-    if 'family' in locals():
-          r =r.filter(C5Dataset.experiment.like(any_(family_dict[family])))
-    if 'var' in locals(): #and 'family' not in locals():
-        r = r.filter(ExtendedMetadata.variable == var)
+        .filter(*filters))
+    if family is not None:
+        if isinstance(family, (list, tuple, set)):
+            patterns = [p for f in family for p in family_dict[f]]
+        else:
+            patterns = family_dict[family]
+        r = r.filter(C5Dataset.experiment.like(any_(patterns)))
+    if var is not None:
+        if isinstance(var, (list, tuple, set)):
+            r = r.filter(ExtendedMetadata.variable.in_(var))
+        else:
+            r = r.filter(ExtendedMetadata.variable == var)
 
     # run the sql using pandas read_sql,index data using path, returns a dataframe
-    df = pandas.read_sql(r.selectable, con=session.connection())
-    # temporary(?) fix to substitute output1/2 with combined
-    fix_paths = df['path'].apply(fix_path, latest=latest)
-    df['pdir'] = fix_paths.map(os.path.dirname)
-    df['filename'] = df['path'].map(os.path.basename)
-    res = df.groupby(['pdir'])
+    # session.connection() returns the connection pinned to the session
+    # transaction, so repeated queries (e.g. matching's combinations loop)
+    # share one connection rather than checking out a new one each time
+    # stream the result set in chunks so peak memory is bounded by the chunk
+    # size rather than the full flat result, fixing the paths of each chunk
+    # as it arrives before assembling the final frame
+    parts = []
+    for df in pandas.read_sql(r.selectable, con=session.connection(),
+                              chunksize=100000):
+        # a query matching nothing still yields one empty chunk, skip it:
+        # rsplit on an empty column would produce no columns to index
+        if df.empty:
+            continue
+        # temporary(?) fix to substitute output1/2 with combined
+        fix_paths = df['path'].apply(fix_path, latest=latest)
+        # split directory and filename with one vectorized rsplit per column
+        # instead of calling os.path.dirname/basename on every row
+        df['pdir'] = fix_paths.str.rsplit('/', n=1, expand=True)[0]
+        df['filename'] = df['path'].str.rsplit('/', n=1, expand=True)[1]
+        parts.append(df)
+    if len(parts) == 0:
+        return results
+    df = parts[0] if len(parts) == 1 else pandas.concat(parts)
+    # the facet columns repeat a handful of values over thousands of rows,
+    # as categories the groupby/sort/unique operations work on integer codes
+    # instead of python strings; path and filename stay objects
+    for col in ('model', 'source_id', 'experiment', 'experiment_id',
+                'ensemble', 'member_id', 'cmor_table', 'table_id',
+                'variable', 'variable_id', 'institute', 'institution_id',
+                'realm', 'frequency'):
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    # iterate the groups directly, re-slicing the full frame once per group
+    # and column through the index lists is much slower
+    res = df.groupby('pdir')
     results=[]
     cols = [x for x in list(df) if x not in ['filename','path','period'] ]
-    for g,v in res.groups.items():
+    for g,gdf in res:
         gdict={}
-        gdict['filenames'] = df['filename'].iloc[list(v)].tolist()
-        nranges = df['period'].iloc[list(v)].tolist()
+        gdict['filenames'] = gdf['filename'].tolist()
+        nranges = gdf['period'].tolist()
+        # the dataset attributes are constant within a group, take them from
+        # the first row rather than scanning every column for unique values
+        first = gdf.iloc[0]
         for c in cols:
-            gdict[c] = df[c].iloc[list(v)].unique()[0]
+            gdict[c] = first[c]
         gdict['periods'] = convert_periods(nranges, gdict['frequency'])
         gdict['fdate'], gdict['tdate'] = get_range(gdict['periods'])
         gdict['time_complete'] = time_axis(gdict['periods'],gdict['fdate'],gdict['tdate'])
@@ -112,10 +175,16 @@ def local_query(session, project='CMIP5', latest=True, **kwargs):
         results.append(gdict)
     return results
 
+# path manipulation patterns for fix_path/get_version, compiled once at
+# import rather than on every row of a query result
+_output_re = re.compile(r'replicas\/CMIP5\/output[12]?\/')
+_version_re = re.compile(r'v\d{8}')
+
+
 def get_version(path):
     '''Retrieve version from path if not available in MAS
     '''
-    mo = re.search(r'v\d{8}', path)
+    mo = _version_re.search(path)
     if mo:
         return  mo.group()
     else:
@@ -187,8 +256,12 @@ def time_axis(periods,fdate,tdate):
     return contiguos
 
 
+@functools.lru_cache(maxsize=None)
 def get_keys(project):
     '''Define valid arguments keys based on project
+
+    The json file is parsed only once per project, the result is cached and
+    should not be modified by callers.
     '''
     # valid_keys has as keys tuple of all valid arguments and as values dictionaries
     # representing the corresponding facet for CMIP5 and CMIP6
@@ -203,8 +276,12 @@ def get_keys(project):
     return valid_keys
 
 
+@functools.lru_cache(maxsize=None)
 def get_facets(project):
     '''Return dictionary of facets to use based on project
+
+    The json file is parsed only once per project, the result is cached and
+    should not be modified by callers.
     '''
     facets =  {'CMIP6': {}, 'CMIP5': {}}
     ffacets = pkg_resources.resource_filename(__name__, 'data/facets.json')
@@ -248,32 +325,56 @@ def check_values(vocabularies, project, args):
         source_id, realm, variable_id, frequency, table_id, experiment_id, attributes, activity_id, source_type = vocabularies
     else:
         raise NotImplementedError(f'Search for {project} not yet implemented')
+    facets = dict(locals())
     for k,v in args.items():
-        if k in locals() and v not in locals()[k]:
-            raise ClefException(f'"{v}" is not a valid value for the facet "{k}" in project {project}')
+        if k not in facets:
+            continue
+        # a constraint can be a single value or a sequence of values,
+        # check each value of a sequence against the vocabulary
+        for value in (v if isinstance(v, (list, tuple, set)) else [v]):
+            if value not in facets[k]:
+                raise ClefException(f'"{value}" is not a valid value for the facet "{k}" in project {project}')
     return args
 
 
+@functools.lru_cache(maxsize=None)
 def load_vocabularies(project):
-    '''
+    '''Load valid values for a project facets from its validation json file
+
+    The file is parsed only once per project and the result is cached for
+    the life of the process, the values are returned as tuples so the cached
+    result cannot be modified by callers.
     '''
     project = project.upper()
     vfile = pkg_resources.resource_filename(__name__, 'data/'+project+'_validation.json')
-    with open(vfile, 'r') as f:
-         data = f.read()
-         models = json.loads(data)['models']
-         realms = json.loads(data)['realms']
-         variables = json.loads(data)['variables']
-         frequencies = json.loads(data)['frequencies']
-         tables = json.loads(data)['tables']
-         experiments = json.loads(data)['experiments']
-         attributes = json.loads(data)['attributes']
-         if project == 'CMIP5':
-             families = json.loads(data)['families']
-         if project == 'CMIP6':
-             activities = json.loads(data)['activities']
-             stypes = json.loads(data)['source_types']
-             return models, realms, variables, frequencies, tables, experiments, attributes, activities, stypes
+    try:
+        # map the file rather than reading it, orjson parses the buffer
+        # straight out of the page cache without an intermediate copy
+        fd = os.open(vfile, os.O_RDONLY)
+    except FileNotFoundError:
+        raise ClefException(f"Vocabularies not defined for project: {project}")
+    try:
+        with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+            try:
+                with memoryview(mm) as mv:
+                    data = _loads(mv)
+            except TypeError:
+                # the stdlib json fallback only accepts str/bytes
+                data = _loads(mm[:])
+    finally:
+        os.close(fd)
+    models = tuple(data['models'])
+    realms = tuple(data['realms'])
+    variables = tuple(data['variables'])
+    frequencies = tuple(data['frequencies'])
+    tables = tuple(data['tables'])
+    experiments = tuple(data['experiments'])
+    attributes = tuple(data['attributes'])
+    if project == 'CMIP6':
+        activities = tuple(data['activities'])
+        stypes = tuple(data['source_types'])
+        return models, realms, variables, frequencies, tables, experiments, attributes, activities, stypes
+    families = tuple(data['families'])
     return models, realms, variables, frequencies, tables, experiments, attributes, families
 
 
@@ -293,31 +394,37 @@ def fix_model(project, models, invert=False):
     '''
     project = project.upper()
     if project  == 'CMIP5':
-        mfile = pkg_resources.resource_filename(__name__, 'data/'+project+'_model_fix.json')
-        with open(mfile, 'r') as f:
-            mdict = json.loads( f.read() )
-        if invert:
-            mfix = {v: k for k, v in mdict.items()}
-        else:
-            mfix = mdict
+        mfix = _model_fix_dict(project, invert)
     return [ mfix[m] if m in mfix.keys() else m for m in models]
 
 
+@functools.lru_cache(maxsize=None)
+def _model_fix_dict(project, invert):
+    '''Load the model fixes json file for fix_model, cached so the mapping
+    is parsed only once per project/direction
+    '''
+    mfile = pkg_resources.resource_filename(__name__, 'data/'+project+'_model_fix.json')
+    with open(mfile, 'r') as f:
+        mdict = json.loads( f.read() )
+    if invert:
+        return {v: k for k, v in mdict.items()}
+    return mdict
+
+
 def call_local_query(s, project, oformat, latest, **kwargs):
-    '''Call local_query for each combination of constraints passed as argument, return datasets/files paths
+    '''Call local_query with all the constraints, return datasets/files paths
+
+    Multiple values for a facet become a SQL IN filter in local_query, so
+    one query covers every combination of the constraints instead of one
+    query (and one database round-trip) per combination.
     '''
 
-    datasets = []
     paths = []
-    combs = [dict(zip(kwargs, x)) for x in itertools.product(*kwargs.values())]
-    for c in combs:
-        datasets.extend( local_query(s,project=project, latest=latest, **c) )
+    datasets = local_query(s, project=project, latest=latest, **kwargs)
     if oformat == 'dataset':
-        for d in datasets:
-            paths.append(d['pdir'])
+        paths = [d['pdir'] for d in datasets]
     elif oformat == 'file':
-        for d in datasets:
-            paths.extend([d['pdir']+"/" + x for x in d['filenames']])
+        paths = [d['pdir']+"/" + x for d in datasets for x in d['filenames']]
     return datasets, paths
 
 
@@ -326,7 +433,7 @@ def fix_path(path, latest):
         and rr3 ACCESS "/files/" path to "/latest/"
     '''
     if '/al33/replicas/CMIP5/output' in path:
-        return re.sub(r'replicas\/CMIP5\/output[12]?\/','replicas/CMIP5/combined/',path)
+        return _output_re.sub('replicas/CMIP5/combined/',path)
     elif '/al33/replicas/CMIP5/unsolicited' in path:
         return path.replace('unsolicited','combined')
     elif '/rr3/publications/CMIP5/output1/CSIRO-BOM' in path and latest:
@@ -359,27 +466,32 @@ def and_filter(results, cols, fixed, **kwargs):
     useful =  set(['version', 'source_id', 'model', 'pdir','dataset_id',
               'cmor_table','table_id', 'ensemble', 'member_id']) - set(fixed)
     fields = ['comb'] + [f for f in useful if f in results[0].keys()]
-    agg_dict = {k: set for k in fields}
+    # aggregate with pandas' C-level unique and only build the python sets
+    # afterwards from the already deduplicated arrays, rather than growing
+    # a set element by element for every row of every group
+    agg_dict = {k: 'unique' for k in fields}
+    # first count the distinct combinations for each simulation, keeping only
+    # the ones which have them all; counting runs in a single vectorized pass
+    # so the python set aggregation below is done just for the selected rows
+    counts = tab.groupby(fixed)['comb'].nunique()
+    keys = counts.index[counts == len(comb)]
+    seltab = tab.merge(keys.to_frame(index=False), on=fixed)
     # group table data by the columns listed in fix_col i.e. model and ensemble
     # and aggregate rows with matching values creating a set for each including path and version
-    # reset the table indexes
-    d = (tab.groupby(fixed)
+    # reset the table indexes and return results as a dictionary
+    d = (seltab.groupby(fixed)
        .agg(agg_dict)
        .reset_index())
-    # create a filter to select the rows where the lenght of the simulation combinations is
-    # is equal to the number of "cols" combinations
-    allvalues = (d['comb'].map(len) == len(comb) )
-    # apply filter to table and return results as a dictionary
-    selection=d[allvalues].to_dict('r')
-    # to subset results based on selection, create a list of tuple with the fixed attributes for selection (sel_fixed)
-    # then do the same for each results and append them to a new list only if they are in sel_fixed
-    sel_attrs = []
-    sel_fixed = []
-    for sim in selection:
-        sel_fixed.append(tuple([sim[a] for a in fixed]))
-    for sim in results:
-        if (tuple([sim[a] for a in fixed])) in sel_fixed:
-            sel_attrs.append(sim)
+    # callers expect sets for the aggregated attributes
+    for f in fields:
+        d[f] = d[f].map(set)
+    selection=d.to_dict('records')
+    # to subset results based on selection, create a set of tuples with the fixed attributes
+    # for selection (sel_fixed), then keep each result whose fixed attributes are in it;
+    # a set makes every membership test a hash lookup instead of a list scan
+    sel_fixed = {tuple(sim[a] for a in fixed) for sim in selection}
+    sel_attrs = [sim for sim in results
+                 if tuple(sim[a] for a in fixed) in sel_fixed]
     return sel_attrs, selection
 
 
@@ -403,6 +515,8 @@ def matching(session, cols, fixed, project='CMIP5', local=True, latest=True, **k
             msg = "There are no simulations stored locally"
             # perform the query for each variable separately and concatenate the results
             combs = [dict(zip(kwargs, x)) for x in itertools.product(*kwargs.values())]
+            # the queries run serially on purpose: they all share the caller's db
+            # session and SQLAlchemy sessions are not safe to use across threads
             for c in combs:
                 results.extend( search(session,project=project.upper(),latest=latest, **c) )
         # use ESGF search
@@ -419,9 +533,11 @@ def matching(session, cols, fixed, project='CMIP5', local=True, latest=True, **k
             query=None
             response = esgf_query(query, fields, latest=latest, **kwquery)
             for row in response['response']['docs']:
-                version = row['dataset_id'].split("|")[0].split(".")[-1]
-                results.append({k:(v[0] if isinstance(v,list) else v) for k,v in row.items()})
-                results[-1]['version'] = version
+                rec = {k:(v[0] if isinstance(v,list) else v) for k,v in row.items()}
+                # version is the last dotted field of the dataset_id, split
+                # only around the pieces we need
+                rec['version'] = row['dataset_id'].split("|", 1)[0].rsplit(".", 1)[-1]
+                results.append(rec)
 
     except Exception as e:
         print('ERROR',str(e))
@@ -435,19 +551,24 @@ def matching(session, cols, fixed, project='CMIP5', local=True, latest=True, **k
 
 def write_csv(list_dicts):
     '''Write query results to csv file
+
+    Accepts a list of dictionaries, as returned by the query functions, or
+    a pandas DataFrame. The rows are encoded by pandas' C csv writer rather
+    than looping through a python DictWriter.
     '''
     if len(list_dicts) == 0:
-        print(f'Nothing to write to csv file')
+        print('Nothing to write to csv file')
         return
-    project = list_dicts[0].get("project", "result")
+    if isinstance(list_dicts, pandas.DataFrame):
+        df = list_dicts
+    else:
+        df = pandas.DataFrame.from_records(list_dicts)
+    project = df['project'].iloc[0] if 'project' in df.columns else 'result'
     csv_file = f'{project.upper()}_query.csv'
     ignore = ['periods', 'filenames', 'institute', 'project', 'institution_id','realm', 'product']
-    columns = [x for x in list_dicts[0].keys() if x not in ignore]
+    columns = [x for x in df.columns if x not in ignore]
     try:
-        with open(csv_file, 'w') as csvfile:
-            writer = csv.DictWriter(csvfile, extrasaction='ignore', fieldnames=columns)
-            writer.writeheader()
-            writer.writerows(list_dicts)
+        df.to_csv(csv_file, columns=columns, index=False)
     except IOError:
         print("I/O error")
 
@@ -458,10 +579,10 @@ def stats(results):
     '''
     stats_dict = {}
     attrs = get_facets(results[0]['project'].upper())
-    # get number of unique models
-    stats_dict['models'] = set(x[attrs['m']] for x in results)
-    # get number of unique models/ensembles
+    # get unique model/ensemble combinations in a single pass over results,
+    # the unique models fall out of that
     stats_dict['model_member'] = set((x[attrs['m']], x[attrs['en']]) for x in results)
+    stats_dict['models'] = set(m for m,en in stats_dict['model_member'])
     # get number of unique ensembles for each model
     stats_dict['members'] = {m:[] for m in stats_dict['models']}
     for m,en in stats_dict['model_member']:
@@ -481,7 +602,6 @@ def print_stats(results):
         print(m, end=' ')
     print()
     print(f'\nA total of {len(stats_dict["model_member"])} unique model-member combinations are available.')
-    member_num = {k: len(v) for k,v in stats_dict['members'].items()}
     member_num = {len(v): [] for v in stats_dict['members'].values()}
     for k,v in stats_dict['members'].items():
         member_num[len(v)].append(k)
@@ -531,8 +651,6 @@ def ids_dict(dids):
                        'time_frequency', 'realm', 'cmor_table', 'ensemble', 'version']
     else:
         print(f'Warning: project {project} not available')
-        return results 
-    for did in dids:
-        results.append({k:v for k,v in zip(facets_list,did.split("."))})
-    return results
+        return results
+    return [dict(zip(facets_list, did.split("."))) for did in dids]
 
@@ -35,6 +35,13 @@ from .pgvalues import values
 from .model import Path, Checksum
 from .exception import ClefException
 
+# orjson decodes the MB-scale ESGF responses noticeably faster than the
+# stdlib parser, fall back to json when it is not installed
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
+
 
 class ESGFException(ClefException):
     """Error from the ESGF API
@@ -96,7 +103,9 @@ def esgf_query(query, fields, otype='File', limit=10000, offset=0,  distrib=True
     except Exception as err:
         raise ClefException(f'Currently is not possible to contact one of the ESGF nodes try again later or use --local option') 
     #r.raise_for_status()
-    return r.json()
+    # decode the raw bytes directly rather than going through r.json(),
+    # which would first build an intermediate text copy of the body
+    return _loads(r.content)
 
 
 def link_to_esgf(query, **kwargs):
@@ -238,6 +247,18 @@ def match_query(session, query, latest=None, **kwargs):
         #return values.outerjoin(Path, Path.path.like('%/'+values.c.title))
         return values.outerjoin(Path, func.regexp_replace(Path.path, '^.*/', '') == values.c.title)
 
+def _rr3_filter(subq):
+    """Filter expression excluding rr3 paths outside the files directories
+
+    Shared by the file and dataset variants of :func:`find_local_path` so the
+    expression tree is only built once per query.
+    """
+    return sa.not_(sa.and_(
+        subq.c.esgf_paths_path.like('/g/data1/rr3/publications/CMIP5/%'),
+        sa.not_(subq.c.esgf_paths_path.like('/g/data1/rr3/publications/CMIP5/%/files/%'))
+    ))
+
+
 def find_local_path(session, subq, oformat='file'):
     """Find the filesystem paths of ESGF matches
 
@@ -252,26 +273,26 @@ def find_local_path(session, subq, oformat='file'):
         Iterable of strings with the paths to either paths or datasets
     """
 
+    # stream rows from the database cursor in batches rather than
+    # materializing the whole result set before the first row is returned
     if oformat == 'file':
         return (session
                  .query('esgf_paths.path')
                  .select_from(subq)
                 .filter(subq.c.esgf_paths_file_id != None)
-                .filter(sa.not_(sa.and_(
-                    subq.c.esgf_paths_path.like('/g/data1/rr3/publications/CMIP5/%'),
-                    sa.not_(subq.c.esgf_paths_path.like('/g/data1/rr3/publications/CMIP5/%/files/%'))
-                )))
+                .filter(_rr3_filter(subq))
+                .execution_options(stream_results=True)
+                .yield_per(1000)
                 )
     elif oformat == 'dataset':
         return (session
                 .query(func.regexp_replace(subq.c.esgf_paths_path, '[^//]*$', ''))
                 .select_from(subq)
                 .filter(subq.c.esgf_paths_file_id != None)
-                .filter(sa.not_(sa.and_(
-                    subq.c.esgf_paths_path.like('/g/data1/rr3/publications/CMIP5/%'),
-                    sa.not_(subq.c.esgf_paths_path.like('/g/data1/rr3/publications/CMIP5/%/files/%'))
-                )))
-                .distinct())
+                .filter(_rr3_filter(subq))
+                .distinct()
+                .execution_options(stream_results=True)
+                .yield_per(1000))
     else:
         raise NotImplementedError
 
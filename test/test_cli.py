@@ -62,15 +62,15 @@ def test_versions(command, runner, mock_query):
     """
 
     # Check the query args are passed correctly
-    cli_run(runner, command)
+    cli_run(runner, command, ['--variable=ts'])
     assert mock_query.called
     assert mock_query.call_args[1]['latest'] is True
 
-    cli_run(runner, command, ['--all-versions'])
+    cli_run(runner, command, ['--variable=ts', '--all-versions'])
     assert mock_query.called
     assert mock_query.call_args[1]['latest'] is None
 
-    cli_run(runner, command, ['--latest'])
+    cli_run(runner, command, ['--variable=ts', '--latest'])
     assert mock_query.called
     assert mock_query.call_args[1]['latest'] is True
 
@@ -86,11 +86,23 @@ def test_mip(command, runner, mock_query):
 def test_remote(command, runner, mock_query):
     ctx = {'search':False, 'local': False, 'missing': False, 'request': False, 'flow': 'remote',
             'log': logging.getLogger('cleflog')}
-    result = runner.invoke(command, [], obj=ctx, catch_exceptions=False)
+    result = runner.invoke(command, ['--variable=ts'], obj=ctx, catch_exceptions=False)
     assert result.exit_code == 0
     assert mock_query.called
 
 
+@pytest.mark.parametrize('command', [cmip5, cmip6])
+def test_unconstrained(command, runner):
+    """
+    A search without any constraint is refused rather than listing the
+    entire catalogue
+    """
+    ctx = {'search':False, 'local': False, 'missing': False, 'request': False, 'flow': 'remote',
+            'log': logging.getLogger('cleflog')}
+    with pytest.raises(ClefException):
+        runner.invoke(command, [], obj=ctx, catch_exceptions=False)
+
+
 def test_variable(runner, mock_query):
     cli_run(runner, cmip5, ['--variable=ts', '--variable=ua'])
     assert mock_query.called
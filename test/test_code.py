@@ -28,6 +28,14 @@ def test_check_values(c5_kwargs, c5_vocab):
     bad_arg['experiment'] = 'dummy'
     with pytest.raises(ClefException):
         args = check_values(c5_vocab, 'CMIP5', bad_arg)
+    # a sequence value is checked element by element
+    list_arg=c5_kwargs.copy()
+    list_arg['variable'] = ['tas']
+    args = check_values(c5_vocab, 'CMIP5', list_arg)
+    assert args == list_arg
+    list_arg['variable'] = ['tas', 'dummy']
+    with pytest.raises(ClefException):
+        args = check_values(c5_vocab, 'CMIP5', list_arg)
 
 def test_check_load_vocabularies():
     project = 'CMIP5'